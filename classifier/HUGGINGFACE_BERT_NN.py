@@ -64,12 +64,13 @@ class HF_BERT_NN(BaseNN):
         dropout_rate = kwargs.get('dropout_rate', 0.5)
 
         ## BUILDING THE GRAPH
-        input_ids = tf.keras.layers.Input(shape=(1,50), name='input_ids', dtype=tf.int32)
-        input_mask = tf.keras.layers.Input(shape=(1,50), name='input_mask', dtype=tf.int32)
+        # the sequence length changes from batch to batch (padding to the longest tweet)
+        input_ids = tf.keras.layers.Input(shape=(None,), name='input_ids', dtype=tf.int32)
+        input_mask = tf.keras.layers.Input(shape=(None,), name='input_mask', dtype=tf.int32)
         #bert_layer = Lambda_Bert_Layer(trainable=False, dynamic=True)
         bert_layer = TFBertForSequenceClassification.from_pretrained('bert-base-uncased')
         bert_layer.bert.trainable=False
-        bert_output = bert_layer(input_ids[:,0,:], attention_mask=input_mask[:,0,:])
+        bert_output = bert_layer(input_ids, attention_mask=input_mask)
         """
         bert_layer.trainable = False
         bert_output=bert_output[0][:,-1,:]
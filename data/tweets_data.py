@@ -29,12 +29,56 @@ USAGE:
 from transformers import BertTokenizer, TFBertModel, AutoTokenizer, BertJapaneseTokenizer, \
     TFBertForSequenceClassification
 import tensorflow as tf
-import tensorflow_datasets as tfds
+import tensorflow_text as tf_text
 from preprocessing import standard_vocab_name
 from preprocessing.pipeline import get_vocabulary
+import numpy as np
+import functools
+import collections
+import threading
+import math
 import data
 import os
 
+_MODULE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# tweets are grouped by their number of words, so that the batches need little padding
+bucket_boundaries = [4, 8, 12, 16, 24]
+
+
+@functools.lru_cache(maxsize=None)
+def _get_tokenizer(name):
+    """Loads the (fast) tokenizer only once, then shares it across the datasets."""
+    return AutoTokenizer.from_pretrained(name, use_fast=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_bert_model(name):
+    """Loads the bert model only once, then shares it across the datasets."""
+    return TFBertModel.from_pretrained(name)
+
+
+def pipeline_options():
+    """Static optimizations of the tf.data pipeline (fused and parallel maps and batches)."""
+    options = tf.data.Options()
+    options.experimental_optimization.map_fusion = True
+    options.experimental_optimization.map_parallelization = True
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_optimization.parallel_batch = True
+    options.autotune.enabled = True
+    options.threading.private_threadpool_size = os.cpu_count()
+    return options
+
+
+def batch_by_length(dataset, batch_size):
+    """Batches together tweets of similar length (the dataset elements are strings or (string, label))."""
+    return dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+        element_length_func=lambda line, *label: tf.size(tf.strings.split(line)),
+        bucket_boundaries=bucket_boundaries,
+        bucket_batch_sizes=[batch_size]*(len(bucket_boundaries)+1),
+        no_padding=True,
+        drop_remainder=True))
+
 
 class TweetDataset():
     "Wrapper class for tf.data.Dataset object"
@@ -73,12 +117,19 @@ class TweetDataset():
         """
         self.input_files = input_files
         self.labels = labels
+        self.batch_size = batch_size
+        self.max_len = max_len
         self.buffer_size = buffer_size
         self.size = size
+        self.bert = bert_embed
+        if bert_embed: self.tokenizer = _get_tokenizer('bert-base-cased')
         self.dataset = self.load_dataset(labels, bert=bert_embed)
+        self.dataset = self.dataset.with_options(pipeline_options())
         self.do_padding = do_padding
         self.steps_per_epoch = None
         self.valid_steps_per_epoch = None
+        self.vocab_table = None
+        self.vocabulary_dimension = None
         if encode_text and not bert_embed:
             if not vocabulary: vocabulary = standard_vocab_name
             self.vocab = get_vocabulary(vocabulary)
@@ -86,35 +137,32 @@ class TweetDataset():
 
         if self.labels:
             self.train, self.validate, self.test = self.split_dataset(batch_size, validation_size,
-                                                                      test_size, max_len)
-            if caching:
-                print("Caching.")
-                abs_path = os.path.abspath(os.path.dirname(__file__))
-                paths = [os.path.join(abs_path, f) for f in
-                         ["../data/train_data", "../data/valid_data", "../data/test_data"]]
-                self.train = self.train.cache(paths[0])
-                self.validate = self.validate.cache(paths[1])
-                self.test = self.test.cache(paths[2])
+                                                                      test_size, max_len, caching)
         else:
-            if self.do_padding:
-                self.dataset = self.dataset.padded_batch(batch_size, padded_shapes=[max_len])
-            self.pred_data = self.dataset.shuffle(self.size)
-
-    @tf.function
-    def get_bert_encoding(self, sentence):
-        """Doing the real Bert job"""
-        encoded_input = self.tokenizer.encode_plus(str(sentence),
-                                                   max_length=50,
-                                                   return_tensors='tf',
-                                                   add_special_tokens=True,
-                                                   return_token_type_ids=False,
-                                                   pad_to_max_length=True,
-                                                   return_attention_mask=True)
-        return encoded_input["input_ids"], encoded_input["attention_mask"]
+            # the prediction data keeps the order of the input lines (see load_dataset)
+            self.pred_data = self.batch_and_encode(self.dataset, batch_size, max_len)
+
+    @property
+    def trans_model(self):
+        """The bert model is only loaded if somebody asks for it"""
+        return _get_bert_model('bert-base-cased')
+
+    def get_bert_encoding(self, sentences):
+        """Doing the real Bert job on a whole batch of sentences (inside the graph)"""
+        # [batch, words, word pieces] --> [batch, word pieces]
+        tokens = self.bert_tokenizer.tokenize(sentences).merge_dims(-2, -1)[:, :self.max_len-2]
+        input_ids, _ = tf_text.combine_segments([tokens],
+                                                start_of_sequence_id=self.cls_id,
+                                                end_of_segment_id=self.sep_id)
+        # padding only up to the longest sentence in the batch
+        input_mask = tf.ones_like(input_ids).to_tensor()
+        input_ids = input_ids.to_tensor()
+        return tf.cast(input_ids, tf.int32), tf.cast(input_mask, tf.int32)
 
     def load_dataset(self, labels, bert=True):
         """
-        :param bert: whether to encode the input using bert --> output shape = [1,768],[2]
+        :param bert: whether to prepare the bert tokenizer for the input (the text is encoded
+            one batch at a time in batch_and_encode) --> output shape = [batch,max_len],[batch,2]
         :param labels: list of labels.
             :type labels: list(int)
             If labels=None the dataset will be loaded in test mode.
@@ -122,105 +170,136 @@ class TweetDataset():
         :return:
         """
         print("Loading the dataset.")
-        ## READING TEXT FILES
-        abs_path = os.path.abspath(os.path.dirname(__file__))
-        paths = [os.path.join(abs_path, f) for f in self.input_files]
-        datasets = []
-        for path in paths:
-            print("Loading ",path)
-            datasets.append(tf.data.TextLineDataset(path).take(self.size//len(paths)))
-        ## EMBEDDING TO BERT (if requested)
-        if bert:
-            print("Applying Bert embedding to the dataset.")
-            self.tokenizer = AutoTokenizer.from_pretrained('bert-base-cased')
-            self.trans_model = TFBertModel.from_pretrained('bert-base-cased')
-            def tf_encode(sentence):
-                result_ids, result_masks = tf.py_function(func=self.get_bert_encoding,
-                                                          inp=[sentence], Tout=(tf.int32,tf.int32))
-                result_ids.set_shape([1,50])
-                result_masks.set_shape([1,50])
-                return (result_ids,result_masks)
-            for i in range(len(datasets)):
-               datasets[i] = datasets[i].map(tf_encode)
+        ## READING TEXT FILES (in parallel, one file per cycle)
+        paths = [os.path.join(_MODULE_DIR, f) for f in self.input_files]
+        lines_per_file = self.size//len(paths)
+        print("Loading ",paths)
         ## ADDING LABELS (if requested)
         if labels:
             assert len(labels) == len(self.input_files)
-            for i in range(len(datasets)):
-                if bert: datasets[i] = datasets[i].map(lambda ids,mask: ((ids,mask),tf.one_hot(labels[i], 2)))
-                else: datasets[i] = datasets[i].map(lambda line: (line,tf.one_hot(labels[i], 2)))
-        ##MERGING the datasets
-        dataset_final = datasets[0]
-        for i in range(len(datasets)-1):
-            dataset_final = dataset_final.concatenate(datasets[i+1])
+            # the labels travel along with the lines through the interleave
+            # (one-hot encoded once here, with numpy)
+            onehots = np.eye(2, dtype=np.float32)[labels]
+            def read_file(path, onehot):
+                return tf.data.Dataset.zip((tf.data.TextLineDataset(path).take(lines_per_file),
+                                            tf.data.Dataset.from_tensors(onehot).repeat()))
+            dataset_final = tf.data.Dataset.from_tensor_slices((paths, onehots))
+            # shuffling the files first, so that a small shuffle buffer is enough afterwards.
+            # Every shuffle is seeded and the interleave is deterministic: the splits are
+            # separate iterators over this dataset, and they must all see the same order
+            dataset_final = dataset_final.shuffle(len(paths), seed=0, reshuffle_each_iteration=False)
+            dataset_final = dataset_final.interleave(read_file,
+                                                     cycle_length=len(paths),
+                                                     num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                                                     deterministic=True)
+        else:
+            # without labels (predictions) the files are read one after the other
+            # and never shuffled, so that the output is aligned with the input lines
+            def read_file(path):
+                return tf.data.TextLineDataset(path).take(lines_per_file)
+            dataset_final = tf.data.Dataset.from_tensor_slices(paths)\
+                .interleave(read_file, cycle_length=1, deterministic=True)
+        ## EMBEDDING TO BERT (if requested)
+        if bert:
+            print("Applying Bert embedding to the dataset.")
+            # the tokenization runs inside the tf graph: no python (and no GIL) in the map
+            vocab = self.tokenizer.get_vocab()
+            vocab_list = sorted(vocab, key=vocab.get)
+            lookup_table = tf.lookup.StaticVocabularyTable(
+                tf.lookup.KeyValueTensorInitializer(vocab_list, tf.range(len(vocab_list), dtype=tf.int64)),
+                num_oov_buckets=1)
+            self.bert_tokenizer = tf_text.BertTokenizer(lookup_table,
+                                                        token_out_type=tf.int64,
+                                                        lower_case=False)
+            self.cls_id, self.sep_id = vocab['[CLS]'], vocab['[SEP]']
+            # note: the encoding itself happens after batching (see batch_and_encode)
 
-        if not labels: dataset_final = dataset_final.map(lambda line: (line))
-        return dataset_final.shuffle(buffer_size=self.size)
+        if not labels: return dataset_final
+        # the buffer is bounded: the full dataset would not fit in memory.
+        # The order is kept fixed across epochs and iterators so that the splits
+        # taken from it do not overlap (the training split is reshuffled in split_dataset)
+        return dataset_final.shuffle(buffer_size=min(self.buffer_size, 100_000),
+                                     seed=0,
+                                     reshuffle_each_iteration=False)
 
     def encode_text(self, vocabulary):
         """Helper function to transform string tokens into integers."""
         print("Encoding the dataset.")
-        vocabulary_set = set(vocabulary.keys())
-        encoder = tfds.features.text.TokenTextEncoder(vocabulary_set)
-
-        # We want to use Dataset.map to apply this function to each element
-        # of the dataset. Dataset.map runs in graph mode so you can't .map
-        # this function directly: You need to wrap it in a tf.py_function.
-        # The tf.py_function will pass regular tensors
-        # (with a value and a .numpy() method to access it),
-        # to the wrapped python function.
-
-        # py_func doesn't set the shape of the returned tensors.
-        # More on py function:
-        # This function allows expressing computations in a TensorFlow graph
-        # as Python functions. In particular, it wraps a Python function func
-        # in a once-differentiable TensorFlow operation that executes
-        # it with eager execution enabled.
-        def encode_map_fn(text, label):
-            encoded_text, label = tf.py_function(lambda t, l: (encoder.encode(t.numpy()), l),
-                                                 inp=[text, label], Tout=(tf.int64, tf.float32))
-            encoded_text.set_shape([None])
-            label.set_shape([])
-            return encoded_text, label
-
-        def encode_map_fn_no_label(text):
-            encoded_text, label = tf.py_function(lambda t: encoder.encode(t.numpy()),
-                                                 inp=[text], Tout=tf.int64)
-            encoded_text.set_shape([None])
-            label.set_shape([])
-            return encoded_text
-
-        # finally applying the transformation word->idx on the dataset
-        if self.labels:
-            self.dataset = self.dataset.map(encode_map_fn)
-        else:
-            self.dataset = self.dataset.map(encode_map_fn_no_label)
+        # The lookup table lives inside the tf graph, hence the encoding
+        # can be applied to a whole batch of text at once (see get_vocab_encoding).
+        # As in the tfds TokenTextEncoder, index 0 is left for the padding,
+        # the words get the indices 1..len(vocabulary) and the unknown tokens len(vocabulary)+1.
+        keys = tf.constant(list(vocabulary.keys()))
+        values = tf.range(1, len(vocabulary)+1, dtype=tf.int64)
+        initializer = tf.lookup.KeyValueTensorInitializer(keys, values)
+        self.vocab_table = tf.lookup.StaticHashTable(initializer, default_value=len(vocabulary)+1)
+        # input dimension of an embedding layer fed with this dataset
+        self.vocabulary_dimension = len(vocabulary)+2
+
+    def get_vocab_encoding(self, text, max_len):
+        """Transforms a batch of text into a batch of vocabulary indices."""
+        encoded_text = self.vocab_table.lookup(tf.strings.split(text))
+        if self.do_padding: return encoded_text.to_tensor(shape=[None, max_len])
+        return encoded_text.to_tensor()
 
-    def split_dataset(self, batch_size, validation_size, test_size, max_len):
-        """Splits the dataset in training and validation."""
+    def split_dataset(self, batch_size, validation_size, test_size, max_len, caching=False):
+        """Splits the dataset in training, validation and test."""
         print("Splitting dataset.")
-        # First calculating the splits
-        print("Batching and shuffling")
-        self.dataset = self.dataset.batch(batch_size)
-        validation_split = int(validation_size*self.size/batch_size) # number of batched in validation
-        test_split = int(test_size*self.size/batch_size) # number of batches in test
-        train_split = int(self.size/batch_size) - validation_split - test_split # number of batches in train
+        cache_paths = [None, None, None]
+        if caching:
+            print("Caching.")
+            cache_paths = [os.path.join(_MODULE_DIR, f) for f in
+                           ["../data/train_data", "../data/valid_data", "../data/test_data"]]
+        # First calculating the splits (on the single tweets, before batching)
+        validation_split = int(validation_size*self.size) # number of tweets in validation
+        test_split = int(test_size*self.size) # number of tweets in test
+        train_split = self.size - validation_split - test_split # number of tweets in train
         print("Training on ",train_split,", validating on ",validation_split,", testing on ",test_split)
         # TRAIN
-        # batching and shuffling
-        self.steps_per_epoch = train_split
+        # with bert each length bucket can leave out one incomplete batch
+        dropped_batches = len(bucket_boundaries) if self.bert else 0
+        self.steps_per_epoch = train_split//batch_size - dropped_batches
         train_data = self.dataset.skip(validation_split + test_split)
-        if self.do_padding: train_data = train_data.padded_batch(batch_size, padded_shapes=([max_len], [1]))
+        train_data = train_data.shuffle(self.buffer_size, reshuffle_each_iteration=True)
         # VALID
         validation_data = self.dataset.take(validation_split)
-        self.valid_steps_per_epoch = validation_split
-        if self.do_padding: validation_data = validation_data.padded_batch(batch_size, padded_shapes=([max_len], [1]))
+        # the last (incomplete) validation batch is kept
+        self.valid_steps_per_epoch = math.ceil(validation_split/batch_size)
         # TEST
         test_data = self.dataset.skip(validation_split).take(test_split)
-        if self.do_padding: test_data = test_data.padded_batch(batch_size, padded_shapes=([max_len], [1]))
 
-        return train_data.prefetch(self.buffer_size), \
-               validation_data.prefetch(self.buffer_size), \
-               test_data.prefetch(self.buffer_size)
+        return self.batch_and_encode(train_data, batch_size, max_len, is_training=True,
+                                     cache_path=cache_paths[0]), \
+               self.batch_and_encode(validation_data, batch_size, max_len, cache_path=cache_paths[1]), \
+               self.batch_and_encode(test_data, batch_size, max_len, cache_path=cache_paths[2])
+
+    def batch_and_encode(self, dataset, batch_size, max_len, is_training=False, cache_path=None):
+        """Batches the dataset and then encodes the text one batch at a time.
+        Only the training data is bucketed by length (and loses its incomplete batches).
+        If a cache_path is given the encoded batches are cached there (and not re-encoded at every epoch)."""
+        print("Batching and encoding")
+        if self.bert and is_training: dataset = batch_by_length(dataset, batch_size)
+        else: dataset = dataset.batch(batch_size, drop_remainder=is_training)
+        def _encode_text(text):
+            if self.bert:
+                return self.get_bert_encoding(text)
+            return self.get_vocab_encoding(text, max_len)
+
+        def _encode_with_label(text, label):
+            return _encode_text(text), label
+
+        if self.bert or self.vocab_table is not None:
+            tf_encode_batch = _encode_with_label if self.labels else _encode_text
+            dataset = dataset.map(tf_encode_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        # the cache sits right after the encoding, before the prefetch
+        if cache_path is not None:
+            dataset = dataset.cache(cache_path)
+            # the cache replays the same batches at every epoch: the training batches
+            # are reshuffled here (the tweets inside a batch stay together)
+            if is_training:
+                dataset = dataset.shuffle(max(self.buffer_size//batch_size, 1),
+                                          reshuffle_each_iteration=True)
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
 
 class TweetDatasetGenerator():
@@ -233,84 +312,103 @@ class TweetDatasetGenerator():
                  train_p=0.3,
                  valid_p=0.1,
                  test_p=0.05,
-                 size = data.full_dimension):
+                 size = data.full_dimension,
+                 encoding_cache_size=200000):
         # --------- Parameters here
         assert(size<data.full_dimension), "The size is too big"
         self.size = size
         self.max_len=max_len
         # these are Bert parameters
-        self.tokenizer = AutoTokenizer.from_pretrained('bert-base-cased')
-        self.trans_model = TFBertModel.from_pretrained('bert-base-cased')
+        self.tokenizer = _get_tokenizer('bert-base-cased')
+        # LRU cache of the token ids of the most recent tweets (there are many duplicates)
+        self.encoding_cache = collections.OrderedDict()
+        self.encoding_cache_size = encoding_cache_size
+        self.encoding_cache_lock = threading.Lock()
         # ---------------------------
 
         ## load the dataset first
-        x,y = self.load_data_from_files(input_files, labels)
-        x,y = self.preprocess_xy(x,y)
+        xy = self.load_data_from_files(input_files, labels)
+        xy = self.preprocess_xy(xy, batch_size)
         train, val, test = \
-            self.split_data(x,y,train_p,valid_p,test_p, batch_size)
-        self.train = self.batch_and_prepare(train, is_training=True, batch_size=batch_size)
-        self.valid= self.batch_and_prepare(val, is_training=False, batch_size=batch_size)
-        self.test = self.batch_and_prepare(test, is_training=False, batch_size=batch_size)
+            self.split_data(xy,train_p,valid_p,test_p, batch_size)
+        self.train = self.batch_and_prepare(train, is_training=True)
+        self.valid= self.batch_and_prepare(val, is_training=False)
+        self.test = self.batch_and_prepare(test, is_training=False)
 
 
+    @property
+    def trans_model(self):
+        """The bert model is only loaded if somebody asks for it"""
+        return _get_bert_model('bert-base-cased')
+
     def load_data_from_files(self,files,labels):
         ## loading and merging the files ----------
         print("Loading from files.")
-        abs_path = os.path.abspath(os.path.dirname(__file__))
-        paths = [os.path.join(abs_path, f) for f in files]
-        # 1. Loading the text
-        # 2. Building the labels
-        datasets = []
-        dataset_labels = []
+        paths = [os.path.join(_MODULE_DIR, f) for f in files]
         length = self.size//len(paths)
-        for i,path in enumerate(paths):
-            print("Loading ", path)
-            datasets.append(tf.data.TextLineDataset(path))
-            dataset_labels.append(tf.data.Dataset.from_tensor_slices([labels[i]]*length))
-        # 3. MERGING the datasets
-        dataset_final = datasets[0]
-        dataset_final_labels = dataset_labels[0]
-        for i in range(len(datasets) - 1):
-            dataset_final = dataset_final.concatenate(datasets[i + 1])
-            dataset_final_labels = dataset_final_labels.concatenate(dataset_labels[i + 1])
-        # 4. shuffling
-        dataset_final = dataset_final.shuffle(buffer_size=length, seed=0).cache(os.path.join(abs_path,"../data/x"))
-        dataset_final_labels = dataset_final_labels.shuffle(buffer_size=length, seed=0).cache(os.path.join(abs_path,"../data/y"))
-        return dataset_final, dataset_final_labels
+        # 1. Loading the text and
+        # 2. Building the labels (one-hot encoded once here, with numpy)
+        onehots = np.eye(2, dtype=np.float32)[labels]
+        def read_file(path, onehot):
+            return tf.data.Dataset.zip((tf.data.TextLineDataset(path).take(length),
+                                        tf.data.Dataset.from_tensors(onehot).repeat()))
+        # 3. MERGING the datasets (the files are read in parallel)
+        dataset_final = tf.data.Dataset.from_tensor_slices((paths, onehots))\
+            .interleave(read_file,
+                        cycle_length=len(paths),
+                        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                        deterministic=True)
+        # 4. shuffling (always in the same order: each split is a separate iterator)
+        dataset_final = dataset_final.shuffle(buffer_size=length, seed=0,
+                                              reshuffle_each_iteration=False)
+        return dataset_final
         ## ----------------------
 
-    def get_bert_encoding(self, sentence):
-        """Doing the real Bert job"""
-        encoded_input = self.tokenizer.encode_plus(str(sentence),
-                                                   max_length=self.max_len,
-                                                   return_tensors='tf',
-                                                   add_special_tokens=True,
-                                                   return_token_type_ids=False,
-                                                   pad_to_max_length=True,
-                                                   return_attention_mask=True)
-        return encoded_input["input_ids"], encoded_input["attention_mask"]
-
-    def preprocess_xy(self, x,y):
-        print("Preprocessing text and labels.")
-        # helper function that hides the python logic to encode the labels
-        def tf_yencode(label):
-            y_encoded = tf.py_function(lambda lbl: tf.one_hot(lbl,2), inp=[label], Tout=tf.float32)
-            y_encoded.set_shape([2])
-            return y_encoded
+    def get_bert_encoding(self, sentences):
+        """Doing the real Bert job on a whole batch of sentences.
+        Each distinct sentence is tokenized once, and only if it is not in the cache."""
+        texts, inverse = np.unique(sentences.numpy(), return_inverse=True)
+        with self.encoding_cache_lock:
+            encoded = {text: self.encoding_cache.get(text) for text in texts}
+        missing = [text for text, ids in encoded.items() if ids is None]
+        if missing:
+            encoded_input = self.tokenizer([text.decode("utf-8") for text in missing],
+                                           max_length=self.max_len,
+                                           truncation=True,
+                                           return_token_type_ids=False,
+                                           return_attention_mask=False)
+            encoded.update(zip(missing, encoded_input["input_ids"]))
+        with self.encoding_cache_lock:
+            for text in texts:
+                self.encoding_cache[text] = encoded[text]
+                self.encoding_cache.move_to_end(text)
+            while len(self.encoding_cache) > self.encoding_cache_size:
+                self.encoding_cache.popitem(last=False)
+        # padding to the longest sentence in the batch
+        lengths = np.array([len(encoded[text]) for text in texts])
+        input_ids = np.zeros((len(texts), lengths.max()), dtype=np.int32)
+        for i, text in enumerate(texts):
+            input_ids[i, :lengths[i]] = encoded[text]
+        input_masks = (np.arange(lengths.max()) < lengths[:, None]).astype(np.int32)
+        return input_ids[inverse], input_masks[inverse]
 
-        y = y.map(tf_yencode, num_parallel_calls=4)
+    def preprocess_xy(self, xy, batch_size):
+        """Batches text and labels and encodes the text one batch at a time."""
+        print("Preprocessing text and labels.")
 
-        def tf_encode(sentence):
+        def tf_encode_batch(sentences, labels):
             result_ids, result_masks = tf.py_function(func=self.get_bert_encoding,
-                                                      inp=[sentence], Tout=(tf.int32, tf.int32))
-            result_ids.set_shape([1, 50])
-            result_masks.set_shape([1, 50])
-            return (result_ids, result_masks)
+                                                      inp=[sentences], Tout=(tf.int32, tf.int32))
+            # the sentences are padded to the longest in the batch
+            result_ids.set_shape([batch_size, None])
+            result_masks.set_shape([batch_size, None])
+            return (result_ids, result_masks), labels
 
-        x = x.map(tf_encode, num_parallel_calls=4)
-        return x,y
+        xy = batch_by_length(xy, batch_size)
+        xy = xy.map(tf_encode_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return xy
 
-    def split_data(self, x, y, train_p, valid_p, test_p, batch_size):
+    def split_data(self, dataset, train_p, valid_p, test_p, batch_size):
         print("Splitting.")
         train_size = int(self.size*train_p)
         valid_size = int(self.size*valid_p)
@@ -319,16 +417,23 @@ class TweetDatasetGenerator():
                                                            valid_size//batch_size, \
                                                            test_size//batch_size
         print("Train: ",train_size,". Valid: ",valid_size,". Test: ",test_size)
-        dataset = tf.data.Dataset.zip((x,y))
-        train = dataset.take(train_size)
-        valid = dataset.skip(train_size).take(valid_size)
-        test = dataset.skip(train_size+valid_size).take(test_size)
+        # the dataset is already batched: the splits are counted in batches
+        train = dataset.take(self.train_size)
+        valid = dataset.skip(self.train_size).take(self.valid_size)
+        test = dataset.skip(self.train_size+self.valid_size).take(self.test_size)
+        # caching the encoded splits (each one is read to the end at every epoch,
+        # hence the tokenizer only runs during the first one)
+        train = train.cache(os.path.join(_MODULE_DIR, "../data/train_encoded"))
+        valid = valid.cache(os.path.join(_MODULE_DIR, "../data/valid_encoded"))
+        test = test.cache(os.path.join(_MODULE_DIR, "../data/test_encoded"))
         return train,valid,test
 
     @staticmethod
-    def batch_and_prepare(dataset,is_training,batch_size):
-        dataset = dataset.batch(batch_size, drop_remainder=is_training)
+    def batch_and_prepare(dataset,is_training):
+        # the batching happens in preprocess_xy, before the encoding
         dataset = dataset.repeat()
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        dataset = dataset.with_options(pipeline_options())
         return dataset
 
 
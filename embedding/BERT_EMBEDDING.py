@@ -1,7 +1,6 @@
 import tensorflow_hub as hub
 import tensorflow as tf
-import bert
-FullTokenizer = bert.bert_tokenization.FullTokenizer
+from transformers import AutoTokenizer
 from tensorflow.keras.models import Model       # Keras is the new high level API for TensorFlow
 import math
 import numpy as np
@@ -11,35 +10,33 @@ def get_masks(tokens, max_seq_length):
     """Mask for padding"""
     if len(tokens)>max_seq_length:
         raise IndexError("Token length more than max seq length!")
-    return [1]*len(tokens) + [0] * (max_seq_length - len(tokens))
+    mask = np.zeros(max_seq_length, dtype=np.int32)
+    mask[:len(tokens)] = 1
+    return mask
 
 
 def get_segments(tokens, max_seq_length):
     """Segments: 0 for the first sequence, 1 for the second"""
     if len(tokens)>max_seq_length:
         raise IndexError("Token length more than max seq length!")
-    segments = []
-    current_segment_id = 0
-    for token in tokens:
-        segments.append(current_segment_id)
-        if token == "[SEP]":
-            current_segment_id = 1
-    return segments + [0] * (max_seq_length - len(tokens))
+    segments = np.zeros(max_seq_length, dtype=np.int32)
+    sep_positions = np.where(np.array(tokens) == "[SEP]")[0]
+    if len(sep_positions) >= 1:
+        # the first [SEP] still belongs to the first sequence
+        segments[sep_positions[0]+1:len(tokens)] = 1
+    return segments
 
 
 def get_ids(tokens, tokenizer, max_seq_length):
     """Token ids from Tokenizer vocab"""
-    token_ids = tokenizer.convert_tokens_to_ids(tokens)
-    input_ids = token_ids + [0] * (max_seq_length-len(token_ids))
+    input_ids = np.zeros(max_seq_length, dtype=np.int32)
+    input_ids[:len(tokens)] = tokenizer.convert_tokens_to_ids(tokens)
     return input_ids
 
 #the embedding dimension of a tweet(sentence) is standard 768
 
-def get_BERT_EMBEDDING(input_files, output_location, max_seq_length=128):
+def get_BERT_EMBEDDING(input_files, output_location, max_seq_length=128, batch_size=128):
     out_dim = 768
-    #the total number of tweets
-    N = 20000
-    output = np.zeros((N, out_dim))
 
     ## FIRST DEFINE THE MODEL
     print("Building Bert model.")
@@ -50,40 +47,38 @@ def get_BERT_EMBEDDING(input_files, output_location, max_seq_length=128):
     pooled_output, sequence_output = bert_layer([input_word_ids, input_mask, segment_ids])
     model = Model(inputs=[input_word_ids, input_mask, segment_ids],
                   outputs=[pooled_output, sequence_output])
+    # the forward pass is compiled once with XLA and reused for every batch
+    input_spec = tf.TensorSpec([None, max_seq_length], tf.int32)
+    @tf.function(jit_compile=True, input_signature=[input_spec]*3)
+    def encode(ids, masks, segments):
+        return model((ids, masks, segments), training=False)[0]
+    # same vocabulary as the hub model (uncased)
+    tokenizer = AutoTokenizer.from_pretrained('bert-base-uncased', use_fast=True)
 
     ## THEN PROCESS THE FILES
     print("Processing the files")
-    for i, file in enumerate(input_files):
+    lines = []
+    for file in input_files:
         with open(file) as f:
-            for l, line in enumerate(f):
-                vocab_file = bert_layer.resolved_object.vocab_file.asset_path.numpy()
-                do_lower_case = bert_layer.resolved_object.do_lower_case.numpy()
-                tokenizer = FullTokenizer(vocab_file, do_lower_case)
-                stokens = tokenizer.tokenize(line)
-                stokens = ["[CLS]"] + stokens + ["[SEP]"]
-                #get the model inputs from the tokens
-                input_ids = get_ids(stokens, tokenizer, max_seq_length)
-                input_masks = get_masks(stokens, max_seq_length)
-                input_segments = get_segments(stokens, max_seq_length)
-                pool_embs, all_embs = model.predict([np.array(input_ids).reshape(1,-1),
-                            np.array(input_masks).reshape(1,-1), np.array(input_segments).reshape(1,-1)])
-                #now we need to store this into a matrix
-                #look at how we did this with the embedding matrix
-                #output dim is also 768 then
-                output[i, :] = pool_embs
-                if l % 10000 == 0:
-                    print(l)
+            lines.extend(f)
+    #the total number of tweets
+    N = len(lines)
+    #get the model inputs (one row per tweet) with a single call to the tokenizer
+    encoded = tokenizer(lines, max_length=max_seq_length, padding='max_length',
+                        truncation=True, return_tensors='np')
+    input_ids = encoded['input_ids'].astype(np.int32)
+    input_masks = encoded['attention_mask'].astype(np.int32)
+    input_segments = encoded['token_type_ids'].astype(np.int32)
+
+    ## FINALLY FEED THE MODEL (one batch of tweets at a time)
+    # the embeddings are stored in half precision: half the memory and disk space
+    output = np.empty((N, out_dim), dtype=np.float16)
+    for start in range(0, N, batch_size):
+        end = start + batch_size
+        pool_embs = encode(input_ids[start:end], input_masks[start:end], input_segments[start:end])
+        #output dim is 768
+        output[start:end] = pool_embs.numpy().astype(np.float16)
+        if (start//batch_size) % 100 == 0:
+            print(start)
     np.savez(output_location, output)
     return output
-
-
-
-
-
-
-
-
-
-
-
-